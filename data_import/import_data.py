@@ -4,7 +4,7 @@ import gzip
 import io
 import json
 from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk, scan
+from elasticsearch.helpers import parallel_bulk, scan
 from elasticsearch.exceptions import NotFoundError
 import validators
 from urllib.parse import urlparse
@@ -12,6 +12,7 @@ import argparse
 import os
 import titlecase
 import datetime
+import itertools
 import math
 import xlsxwriter
 
@@ -21,19 +22,19 @@ def title_exceptions(word, **kwargs):
     word_test = word.strip("(){}<>.")
 
     # lowercase words
-    if word_test.lower() in ['a', 'an', 'of', 'the', 'is', 'or']:
+    if word_test.lower() in {'a', 'an', 'of', 'the', 'is', 'or'}:
         return word.lower()
 
     # uppercase words
-    if word_test.upper() in ['UK', 'FM', 'YMCA', 'PTA', 'PTFA',
+    if word_test.upper() in {'UK', 'FM', 'YMCA', 'PTA', 'PTFA',
                              'NHS', 'CIO', 'U3A', 'RAF', 'PFA', 'ADHD',
                              'I', 'II', 'III', 'IV', 'V', 'VI', 'VII', 'VIII', 'IX', 'X', 'XI',
                              'AFC', 'CE', 'CIC'
-                             ]:
+                             }:
         return word.upper()
 
     # words with only vowels that aren't all uppercase
-    if word_test.lower() in ['st', 'mr', 'mrs', 'ms', 'ltd', 'dr', 'cwm', 'clwb', 'drs']:
+    if word_test.lower() in {'st', 'mr', 'mrs', 'ms', 'ltd', 'dr', 'cwm', 'clwb', 'drs'}:
         return None
 
     # words with number ordinals
@@ -43,13 +44,15 @@ def title_exceptions(word, **kwargs):
 
     # words with dots/etc in the middle
     for s in [".", "'", ")"]:
+        if s not in word:
+            continue
         dots = word.split(s)
         if(len(dots) > 1):
             # check for possesive apostrophes
             if s == "'" and dots[-1].upper() == "S":
                 return s.join([titlecase.titlecase(i, title_exceptions) for i in dots[:-1]] + [dots[-1].lower()])
             # check for you're and other contractions
-            if word_test.upper() in ["YOU'RE", "DON'T", "HAVEN'T"]:
+            if word_test.upper() in {"YOU'RE", "DON'T", "HAVEN'T"}:
                 return s.join([titlecase.titlecase(i, title_exceptions) for i in dots[:-1]] + [dots[-1].lower()])
             return s.join([titlecase.titlecase(i, title_exceptions) for i in dots])
 
@@ -400,18 +403,19 @@ def import_extract_registration(chars={}, datafile=os.path.join("data", "ccew",
                 new_rem_date = None
                 try:
                     new_reg_date = datetime.datetime.strptime( row[2], "%Y-%m-%d %H:%M:%S" )
-                except ValueError:
+                except (TypeError, ValueError):
                     pass
-                if row[3]:
+                # removal dates are only used for inactive charities, so don't parse them otherwise
+                if row[3] and not chars[regno]["active"]:
                     try:
                         new_rem_date = datetime.datetime.strptime( row[3], "%Y-%m-%d %H:%M:%S" )
                     except ValueError:
                         pass
                 date_registered = chars[regno].get("date_registered")
                 date_removed = chars[regno].get("date_removed")
-                if not date_registered or date_registered > new_reg_date:
+                if new_reg_date and (not date_registered or date_registered > new_reg_date):
                     chars[regno]["date_registered"] = new_reg_date
-                if not chars[regno]["active"] and new_rem_date and (not date_removed or (date_removed < new_rem_date)):
+                if new_rem_date and (not date_removed or (date_removed < new_rem_date)):
                     chars[regno]["date_removed"] = new_rem_date 
                 ccount += 1
                 if ccount % 10000 == 0:
@@ -681,15 +685,21 @@ def clean_chars(chars={}, pc_es=None, es_pc_index="postcode", es_pc_type="postco
 
     ccount = 0
     geocount = 0
+    last_modified = datetime.datetime.now()
+    # many charities share a postcode, so only look each one up once
+    postcodes = {}
     for c in chars:
         if pc_es:
-            geo_data = fetch_postcode(chars[c]["geo"]["postcode"], pc_es, es_pc_index, es_pc_type)
+            postcode = chars[c]["geo"]["postcode"]
+            if postcode not in postcodes:
+                postcodes[postcode] = fetch_postcode(postcode, pc_es, es_pc_index, es_pc_type)
+            geo_data = postcodes[postcode]
             if geo_data:
                 chars[c]["geo"]["location"] = geo_data[0]
-                chars[c]["geo"]["areas"] = geo_data[1]
+                chars[c]["geo"]["areas"] = dict(geo_data[1])
                 geocount += 1
 
-        chars[c] = clean_char(chars[c])
+        chars[c] = clean_char(chars[c], last_modified)
 
         ccount += 1
         if ccount % 10000 == 0:
@@ -699,7 +709,7 @@ def clean_chars(chars={}, pc_es=None, es_pc_index="postcode", es_pc_type="postco
 
     return chars
 
-def clean_char(char):
+def clean_char(char, last_modified=None):
     
     char["url"] = parse_url(char["url"])
     char["domain"] = get_domain(char["url"])
@@ -708,35 +718,80 @@ def clean_char(char):
     if not char["known_as"]:
         char["known_as"] = char["names"][0]["name"]
 
-    names = list(set([n["name"] for n in char["names"]
-                if n["name"] != char["known_as"] and n["name"]]))
+    # dedupe with a dict so names keep the order they were added in
+    names = list(dict.fromkeys(n["name"] for n in char["names"]
+                               if n["name"] != char["known_as"] and n["name"]))
 
     char["alt_names"] = names
     all_names = names + [char["known_as"]]
-    words = set()
-    for n in all_names:
-        if n:
-            w = n.split()
-            words.update([" ".join(w[r:]) for r in range(len(w))])
     char["complete_names"] = {
-        "input": list(words),
+        "input": get_complete_names(all_names),
         "weight": max(1, math.ceil(math.log1p((char.get("latest_income", 0) or 0))))
     }
 
-    char["last_modified"] = datetime.datetime.now()
+    char["last_modified"] = last_modified or datetime.datetime.now()
     
     # @TODO capitalisation of names
 
     return char
 
 
-def save_to_elasticsearch(chars, es, es_index):
+def get_complete_names(all_names):
+    """
+    get every word suffix of each name, for use in autocomplete
+    """
+    seen = set()
+    words = []
+    for n in all_names:
+        if not n:
+            continue
+        w = n.split()
+        for r in range(len(w)):
+            # the full name doesn't need to be rebuilt
+            suffix = " ".join(w[r:]) if r else n
+            if suffix not in seen:
+                seen.add(suffix)
+                words.append(suffix)
+    return words
+
+
+def save_to_elasticsearch(chars, es, es_index, thread_count=4, chunk_size=1000, queue_size=4):
 
     print('\r', "[elasticsearch] %s charities to save" % len(chars))
     print('\r', "[elasticsearch] saving %s charities to %s index" % (len(chars), es_index))
-    results = bulk(es, list(chars.values()), raise_on_error=False, request_timeout=60)
-    print('\r', "[elasticsearch] saved %s charities to %s index" % (results[0], es_index))
-    print('\r', "[elasticsearch] %s errors reported" % len(results[1]))
+    saved = 0
+    errors = []
+
+    # turn off refreshes while saving - live searches won't see any of the
+    # updates until the import finishes and the index is refreshed below
+    settings = es.indices.get_settings(index=es_index, name="index.refresh_interval")
+    refresh_interval = None  # None puts back the index default
+    for index_settings in settings.values():
+        refresh_interval = index_settings["settings"].get("index", {}).get("refresh_interval")
+    es.indices.put_settings(index=es_index, body={"index": {"refresh_interval": "-1"}})
+    try:
+        # send several chunks at once so elasticsearch isn't left waiting on us.
+        # parallel_bulk in elasticsearch 5.x reads all of its input straight away,
+        # so only give it queue_size chunks per thread at a time to keep memory bounded
+        records = iter(chars.values())
+        batch_size = chunk_size * thread_count * queue_size
+        while True:
+            batch = list(itertools.islice(records, batch_size))
+            if not batch:
+                break
+            results = parallel_bulk(es, batch, thread_count=thread_count,
+                                    chunk_size=chunk_size, max_chunk_bytes=10 * 1024 * 1024,
+                                    raise_on_error=False, request_timeout=60)
+            for ok, info in results:
+                if ok:
+                    saved += 1
+                else:
+                    errors.append(info)
+    finally:
+        es.indices.put_settings(index=es_index, body={"index": {"refresh_interval": refresh_interval}})
+        es.indices.refresh(index=es_index)
+    print('\r', "[elasticsearch] saved %s charities to %s index" % (saved, es_index))
+    print('\r', "[elasticsearch] %s errors reported" % len(errors))
 
 
 def create_outputs(es,
@@ -781,7 +836,9 @@ def create_outputs(es,
     worksheet.write_row(0, 0, headers)
     xl_row = 1
 
-    chars = []
+    # write the json output as records arrive rather than holding them all in memory
+    outputs["json"].write('{"charities": [')
+
     for ccount, i in enumerate(res):
         i["_source"]["id"] = i["_id"]
         flat_i = {}
@@ -793,7 +850,9 @@ def create_outputs(es,
             else:
                 flat_i[h] = i["_source"].get(h)
 
-        chars.append(i["_source"])
+        if ccount > 0:
+            outputs["json"].write(', ')
+        json.dump(i["_source"], outputs["json"])
 
         json.dump(i["_source"], outputs["jsonl"])
         outputs["jsonl"].write('\n')
@@ -808,7 +867,7 @@ def create_outputs(es,
     
     print('\r', "[Output] %s records written to output files" % ccount)
 
-    json.dump({"charities": chars}, outputs["json"])
+    outputs["json"].write(']}')
 
     for i, f in outputs.items():
         print("[Output] Records saved to {}".format(getattr(f, "name", getattr(f, "filename", i))))
@@ -835,6 +894,8 @@ def main():
     parser.add_argument('--es-use-ssl', action='store_true', help='Use ssl to connect to elasticsearch')
     parser.add_argument('--es-index', default='charitysearch', help='index used to store charity data')
     parser.add_argument('--es-type', default='charity', help='type used to store charity data')
+    parser.add_argument('--es-bulk-threads', type=int, default=4, help='number of threads used to save data to elasticsearch')
+    parser.add_argument('--es-bulk-limit', type=int, default=1000, help='number of records sent to elasticsearch in each bulk request')
 
     # elasticsearch postcode options
     parser.add_argument('--es-pc-host', default=None, help='host for the postcode elasticsearch instance')
@@ -910,7 +971,7 @@ def main():
         for r in random_keys:
             print(r, chars[r])
     
-    save_to_elasticsearch(chars, es, args.es_index)
+    save_to_elasticsearch(chars, es, args.es_index, args.es_bulk_threads, args.es_bulk_limit)
 
     if args.output:
         create_outputs(es, args.folder, args.es_index, args.es_type)
@@ -1,5 +1,6 @@
 import argparse
 import os
+import datetime
 from elasticsearch import Elasticsearch
 from elasticsearch.helpers import scan
 from import_data import clean_char, save_to_elasticsearch
@@ -19,6 +20,8 @@ def main():
     parser.add_argument('--es-use-ssl', action='store_true', help='Use ssl to connect to elasticsearch')
     parser.add_argument('--es-index', default='charitysearch', help='index used to store charity data')
     parser.add_argument('--es-type', default='charity', help='type used to store charity data')
+    parser.add_argument('--es-bulk-threads', type=int, default=4, help='number of threads used to save data to elasticsearch')
+    parser.add_argument('--es-bulk-limit', type=int, default=1000, help='number of records sent to elasticsearch in each bulk request')
 
     # elasticsearch postcode options
     parser.add_argument('--es-pc-host', default=None, help='host for the postcode elasticsearch instance')
@@ -55,15 +58,17 @@ def main():
             
     res = scan(es, index=args.es_index, doc_type=args.es_type)
     chars = {}
+    last_modified = datetime.datetime.now()
     for r in res:
-        char = {
-            **r["_source"], 
+        # each hit is a fresh dict, so add the bulk metadata in place rather than copying it
+        char = r["_source"]
+        char.update({
             "_index": r["_index"],
             "_type": r["_type"],
             "_op_type": "index",
             "_id": r["_id"],
-        }
-        chars[r["_id"]] = clean_char(char)
+        })
+        chars[r["_id"]] = clean_char(char, last_modified)
         if len(chars) % 10000 == 0:
             print('\r', "[Fetch] %s charites fetched from index" % len(chars), end='')
     print('\r', "[Fetch] %s charites fetched from index" % len(chars))
@@ -75,7 +80,7 @@ def main():
         for r in random_keys:
             print(r, chars[r])
     
-    save_to_elasticsearch(chars, es, args.es_index)
+    save_to_elasticsearch(chars, es, args.es_index, args.es_bulk_threads, args.es_bulk_limit)
 
 if __name__ == '__main__':
     main()
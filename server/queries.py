@@ -2,28 +2,66 @@
 Useful functions for creating queries
 """
 import json
+from functools import lru_cache
+
 import yaml
+from elasticsearch.exceptions import TransportError
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+# use orjson if it's available as it's quicker at building query bodies
+try:
+    import orjson
+
+    def dumps(obj):
+        return orjson.dumps(obj).decode("utf8")
+
+    loads = orjson.loads
+except ImportError:
+    dumps = json.dumps
+    loads = json.loads
+
+
+def load_query_template(filename):
+    """
+    Read a query template from a yaml file and return it serialised as json
+
+    Parsing the json string gives a fresh copy of the template for each request
+    """
+    with open(filename, 'rb') as yaml_file:
+        return json.dumps(yaml.load(yaml_file, Loader=SafeLoader))
+
+
+SEARCH_QUERY_TEMPLATE = load_query_template('./es_config.yml')
+RECON_QUERY_TEMPLATE = load_query_template('./recon_config.yml')
+
 
+@lru_cache(maxsize=4096)
 def search_query(term):
     """
     Fetch the search query and insert the query term
+
+    Queries are cached as popular search terms are requested repeatedly
     """
-    with open('./es_config.yml', 'rb') as yaml_file:
-        json_q = yaml.load(yaml_file)
-        for param in json_q["params"]:
-            json_q["params"][param] = term
-        return json.dumps(json_q)
+    json_q = loads(SEARCH_QUERY_TEMPLATE)
+    for param in json_q["params"]:
+        json_q["params"][param] = term
+    return dumps(json_q)
 
 
+@lru_cache(maxsize=4096)
 def recon_query(term):
     """
     Fetch the reconciliation query and insert the query term
+
+    Queries are cached as the same names often appear in many reconciliation requests
     """
-    with open('./recon_config.yml', 'rb') as yaml_file:
-        json_q = yaml.load(yaml_file)
-        for param in json_q["params"]:
-            json_q["params"][param] = term
-        return json.dumps(json_q)
+    json_q = loads(RECON_QUERY_TEMPLATE)
+    for param in json_q["params"]:
+        json_q["params"][param] = term
+    return dumps(json_q)
 
 
 def esdoc_orresponse(query, app):
@@ -37,6 +75,38 @@ def esdoc_orresponse(query, app):
         body=query,
         ignore=[404]
     )
+    return recon_hits(res, query)
+
+
+def esdoc_orresponses(queries, app):
+    """Run several reconciliation queries and decorate the results
+
+    All the queries are sent to elasticsearch in a single multi search request,
+    and the responses are returned in the same order as the queries.
+    """
+    if not queries:
+        return []
+    res = app.config["es"].msearch_template(
+        index=app.config["es_index"],
+        doc_type=app.config["es_type"],
+        body="".join("{}\n%s\n" % query for query in queries),
+    )
+    return [recon_hits(r, query) for r, query in zip(res["responses"], queries)]
+
+
+def recon_hits(res, query):
+    """Turn the hits from an elasticsearch response into OpenRefine results
+    """
+    if "hits" not in res:
+        error = res.get("error")
+        if isinstance(error, dict):
+            error = error.get("type", error)
+        # a missing index just means there are no candidates
+        if res.get("status") == 404 or error == "index_not_found_exception":
+            return {"result": []}
+        # anything else (eg rejected or failed searches) should be reported, not treated as no match
+        raise TransportError(res.get("status", "N/A"), error, res)
+    term = json.loads(query)["params"]["name"].lower()
     res["hits"]["result"] = res["hits"].pop("hits")
     for i in res["hits"]["result"]:
         i["id"] = i.pop("_id")
@@ -47,7 +117,7 @@ def esdoc_orresponse(query, app):
         i["name"] = i["source"]["known_as"] + " (" + i["id"] + ")"
         if not i["source"]["active"]:
             i["name"] += " [INACTIVE]"
-        if i["source"]["known_as"].lower() == json.loads(query)["params"]["name"].lower() and i["score"] == res["hits"]["max_score"]:
+        if i["source"]["known_as"].lower() == term and i["score"] == res["hits"]["max_score"]:
             i["match"] = True
         else:
             i["match"] = False
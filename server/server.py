@@ -3,6 +3,7 @@ Run the find that charity server
 """
 from __future__ import print_function
 import os
+import sys
 import argparse
 import json
 from collections import OrderedDict
@@ -13,10 +14,11 @@ import re
 from dateutil import parser
 import bottle
 from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import TransportError
 import requests
 from bs4 import BeautifulSoup
 
-from queries import search_query, recon_query, service_spec, esdoc_orresponse
+from queries import search_query, recon_query, service_spec, esdoc_orresponse, esdoc_orresponses
 from csv_upload import csv_app
 
 app = bottle.default_app()
@@ -131,29 +133,36 @@ def reconcile():
         bottle.request.urlparts.netloc,
     )
 
-    # if we're doing a callback request then do that
-    if bottle.request.query.callback:
+    try:
+        # if we're doing a callback request then do that
+        if bottle.request.query.callback:
+            if bottle.request.query.query:
+                bottle.response.content_type = "application/javascript"
+                return "%s(%s);" % (bottle.request.query.callback, json.dumps(esdoc_orresponse(query, app)))
+            else:
+                return "%s(%s);" % (bottle.request.query.callback, json.dumps(service_spec(app, service_url)))
+
+        # try fetching the query as json data or a string
         if bottle.request.query.query:
-            bottle.response.content_type = "application/javascript"
-            return "%s(%s);" % (bottle.request.query.callback, json.dumps(esdoc_orresponse(query, app)))
-        else:
-            return "%s(%s);" % (bottle.request.query.callback, json.dumps(service_spec(app, service_url)))
-
-    # try fetching the query as json data or a string
-    if bottle.request.query.query:
-        return esdoc_orresponse(query, app)
-
-    if queries:
-        queries_json = json.loads(queries)
-        queries_dict = json.loads(queries, object_pairs_hook=OrderedDict)
-        results = {}
-        counter = 0
-        for query_id in queries_dict:
-            result = esdoc_orresponse(recon_query(
-                queries_json[query_id]["query"]), app)["result"]
-            results.update({query_id: {"result": result}})
-            counter += 1
-        return results
+            return esdoc_orresponse(query, app)
+
+        if queries:
+            queries_json = json.loads(queries)
+            queries_dict = json.loads(queries, object_pairs_hook=OrderedDict)
+            query_ids = list(queries_dict)
+            # fetch all the queries from elasticsearch in one request
+            responses = esdoc_orresponses([
+                recon_query(queries_json[query_id]["query"]) for query_id in query_ids
+            ], app)
+            results = {}
+            for query_id, response in zip(query_ids, responses):
+                results.update({query_id: {"result": response["result"]}})
+            return results
+    except TransportError as e:
+        # let the client know the search failed (and could be retried) rather than returning no matches
+        print("[elasticsearch] reconciliation search failed: {}".format(e.info), file=sys.stderr)
+        status = e.status_code if isinstance(e.status_code, int) else 502
+        bottle.abort(status, "Reconciliation search failed: {}".format(e.error))
 
     # otherwise just return the service specification
     return service_spec(app, service_url)